@@ -1,18 +1,70 @@
 import os
+import queue
+import atexit
 import asyncio
+import logging
+from logging.handlers import QueueHandler, QueueListener
 from openai import AsyncAzureOpenAI
 import chainlit as cl
 from uuid import uuid4
 from chainlit.logger import logger
 
 from realtime import RealtimeClient
-from realtime.tools import tools
+from realtime.tools import TOOLS_BY_NAME, TOOLS_JSON, DISPATCH, stop_message_sender
+
+def setup_log_queue():
+    """Route root logging through a queue so handler I/O runs off the event loop."""
+    root = logging.getLogger()
+    handlers = root.handlers[:] or [logging.StreamHandler()]
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_log_queue()
+
+# Audio deltas from the realtime API are tiny; merge up to ~100ms of
+# 24kHz PCM16 into each chunk sent to the browser
+AUDIO_BATCH_BYTES = 4800
 
 client = AsyncAzureOpenAI(api_key=os.environ["AZURE_OPENAI_API_KEY"],
                         azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
                         azure_deployment=os.environ["AZURE_OPENAI_DEPLOYMENT"],
                         api_version="2024-10-01-preview")    
 
+async def stream_audio(queue: asyncio.Queue, track_id: str):
+    """Send queued audio for one track, merging whatever has piled up into a single chunk."""
+    while True:
+        chunks = [await queue.get()]
+        size = len(chunks[0])
+        while not queue.empty() and size < AUDIO_BATCH_BYTES:
+            chunk = queue.get_nowait()
+            chunks.append(chunk)
+            size += len(chunk)
+        await cl.context.emitter.send_audio_chunk(cl.OutputAudioChunk(mimeType="pcm16", data=b"".join(chunks), track=track_id))
+
+def get_audio_queue() -> asyncio.Queue:
+    """Return the audio queue for the current track, starting a new sender when the track changes."""
+    track_id = cl.user_session.get("track_id")
+    audio_stream = cl.user_session.get("audio_stream")
+    if audio_stream and audio_stream[0] == track_id:
+        return audio_stream[1]
+    stop_audio_stream()
+    queue = asyncio.Queue()
+    task = asyncio.create_task(stream_audio(queue, track_id))
+    cl.user_session.set("audio_stream", (track_id, queue, task))
+    return queue
+
+def stop_audio_stream():
+    """Stop the current audio sender, dropping any audio it has not sent yet."""
+    audio_stream = cl.user_session.get("audio_stream")
+    if audio_stream:
+        audio_stream[2].cancel()
+        cl.user_session.set("audio_stream", None)
+
 async def setup_openai_realtime(system_prompt: str):
     """Instantiate and configure the OpenAI Realtime Client"""
     openai_realtime = RealtimeClient(system_prompt = system_prompt)
@@ -26,7 +78,9 @@ async def setup_openai_realtime(system_prompt: str):
             # Only one of the following will be populated for any given event
             if 'audio' in delta:
                 audio = delta['audio']  # Int16Array, audio added
-                await cl.context.emitter.send_audio_chunk(cl.OutputAudioChunk(mimeType="pcm16", data=audio, track=cl.user_session.get("track_id")))
+                # Each event runs in its own task; enqueue without awaiting so
+                # chunks keep their arrival order
+                get_audio_queue().put_nowait(audio)
                 
             if 'arguments' in delta:
                 arguments = delta['arguments']  # string, function arguments added
@@ -43,6 +97,7 @@ async def setup_openai_realtime(system_prompt: str):
     
     async def handle_conversation_interrupt(event):
         """Used to cancel the client previous audio playback."""
+        stop_audio_stream()
         cl.user_session.set("track_id", str(uuid4()))
         await cl.context.emitter.send_audio_interrupt()
         
@@ -65,8 +120,7 @@ async def setup_openai_realtime(system_prompt: str):
     openai_realtime.on('error', handle_error)
 
     cl.user_session.set("openai_realtime", openai_realtime)
-    coros = [openai_realtime.add_tool(tool_def, tool_handler) for tool_def, tool_handler in tools]
-    await asyncio.gather(*coros)
+    await openai_realtime.add_tools(TOOLS_BY_NAME.values(), TOOLS_JSON, DISPATCH)
     
     
 system_prompt = """You are a customer service assistant for ShopMe.
@@ -147,6 +201,8 @@ async def on_audio_chunk(chunk: cl.InputAudioChunk):
 @cl.on_chat_end
 @cl.on_stop
 async def on_end():
+    stop_audio_stream()
+    await stop_message_sender()
     openai_realtime: RealtimeClient = cl.user_session.get("openai_realtime")
     if openai_realtime and openai_realtime.is_connected():
         await openai_realtime.disconnect()
\ No newline at end of file
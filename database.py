@@ -1,251 +1,289 @@
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncio
+import logging
+import asyncpg
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from decimal import Decimal
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Database connection string
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-def get_db_connection():
-    """Create a database connection"""
-    try:
-        # ONLY CHANGE: Add sslmode='require' for Supabase
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        conn.autocommit = True
-        return conn
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return None
+# Shared connection pool, created on first use so importing this module
+# doesn't require the database to be reachable
+_pool = None
+_pool_lock = asyncio.Lock()
+
+# Customers are looked up by most tool calls in a session; keep recent rows
+# for a minute to skip the repeat SELECTs
+_customer_cache = TTLCache(maxsize=1024, ttl=60)
+
+async def get_pool():
+    """Return the shared connection pool, creating it if needed"""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                # ssl='require' for Supabase
+                _pool = await asyncpg.create_pool(
+                    DATABASE_URL,
+                    ssl='require',
+                    min_size=1,
+                    max_size=10
+                )
+    return _pool
+
+# Retry queries that hit a dropped or refused connection instead of failing
+# the tool call; other errors (bad SQL, constraint violations) are not retried.
+# Only reads and idempotent writes go through the retried helpers
+_db_retry = retry(
+    retry=retry_if_exception_type((
+        asyncpg.PostgresConnectionError,
+        asyncpg.ConnectionDoesNotExistError,
+        OSError
+    )),
+    wait=wait_exponential(multiplier=0.5, max=5),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
 
-# ALL OTHER FUNCTIONS REMAIN EXACTLY THE SAME
-# No other changes needed in this file
+@_db_retry
+async def _fetch(query, *args):
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetch(query, *args)
 
-def get_customer_by_id(customer_id):
+@_db_retry
+async def _fetchrow(query, *args):
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(query, *args)
+
+@_db_retry
+async def _execute(query, *args):
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.execute(query, *args)
+
+async def _execute_once(query, *args):
+    # For writes that aren't safe to repeat: if the connection drops after the
+    # statement commits, a retry would apply it twice
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await conn.execute(query, *args)
+
+def _rows_affected(status):
+    """Parse the row count from an asyncpg command status such as 'UPDATE 1'"""
+    return int(status.split()[-1])
+
+async def get_customer_by_id(customer_id):
     """Get a customer by ID"""
     try:
-        conn = get_db_connection()
-        if not conn:
+        customer_id = int(customer_id)
+        if customer_id in _customer_cache:
+            return _customer_cache[customer_id]
+
+        customer = await _fetchrow(
+            "SELECT * FROM customers WHERE customer_id = $1",
+            customer_id
+        )
+        if not customer:
             return None
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "SELECT * FROM customers WHERE customer_id = %s",
-                (customer_id,)
-            )
-            customer = cursor.fetchone()
-        conn.close()
-        return customer
-    except Exception as e:
-        print(f"Error getting customer: {e}")
+
+        _customer_cache[customer_id] = dict(customer)
+        return _customer_cache[customer_id]
+    except Exception:
+        logger.exception("Error getting customer")
         return None
 
-def get_customer_orders(customer_id):
-    """Get all orders for a customer"""
+async def get_customer_orders(customer_id):
+    """Get all orders for a customer, or None if the lookup failed"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return []
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "SELECT * FROM orders WHERE customer_id = %s ORDER BY order_date DESC",
-                (customer_id,)
-            )
-            orders = cursor.fetchall()
-        conn.close()
-        return orders
-    except Exception as e:
-        print(f"Error getting orders: {e}")
-        return []
+        orders = await _fetch(
+            "SELECT * FROM orders WHERE customer_id = $1 ORDER BY order_date DESC",
+            int(customer_id)
+        )
+        return [dict(order) for order in orders]
+    except Exception:
+        logger.exception("Error getting orders")
+        return None
 
-def get_order_details(order_id, customer_id):
+async def get_order_details(order_id, customer_id):
     """Get details of a specific order"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return datetime.now() + timedelta(days=5), "Error", datetime.now()
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                """
-                SELECT o.order_date, o.status, o.estimated_delivery 
-                FROM orders o
-                WHERE o.order_id = %s AND o.customer_id = %s
-                """,
-                (order_id, customer_id)
+        order = await _fetchrow(
+            """
+            SELECT o.order_date, o.status, o.estimated_delivery
+            FROM orders o
+            WHERE o.order_id = $1 AND o.customer_id = $2
+            """,
+            int(order_id), int(customer_id)
+        )
+
+        if order:
+            estimated_delivery = order['estimated_delivery']
+            status = order['status']
+            order_date = order['order_date']
+            return estimated_delivery, status, order_date
+        else:
+            # Return default values if order not found
+            return (
+                datetime.now() + timedelta(days=5),  # Default estimated delivery
+                "Not Found",                         # Default status
+                datetime.now()                       # Default order date
             )
-            order = cursor.fetchone()
-            
-            if order:
-                estimated_delivery = order['estimated_delivery']
-                status = order['status']
-                order_date = order['order_date']
-                return estimated_delivery, status, order_date
-            else:
-                # Return default values if order not found
-                return (
-                    datetime.now() + timedelta(days=5),  # Default estimated delivery
-                    "Not Found",                         # Default status
-                    datetime.now()                       # Default order date
-                )
-    except Exception as e:
-        print(f"Error getting order details: {e}")
+    except Exception:
+        logger.exception("Error getting order details")
         # Return default values on error
         return (
             datetime.now() + timedelta(days=5),
             "Error",
             datetime.now()
         )
-    finally:
-        if conn:
-            conn.close()
 
-def get_order_items(order_id):
+async def get_order_items(order_id):
     """Get all items in an order"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return []
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "SELECT * FROM order_items WHERE order_id = %s",
-                (order_id,)
-            )
-            items = cursor.fetchall()
-        conn.close()
-        return items
-    except Exception as e:
-        print(f"Error getting order items: {e}")
+        items = await _fetch(
+            "SELECT * FROM order_items WHERE order_id = $1",
+            int(order_id)
+        )
+        return [dict(item) for item in items]
+    except Exception:
+        logger.exception("Error getting order items")
         return []
 
-def update_order(customer_id, order_id, item_id, new_product_name=None, new_quantity=None):
+async def get_item_by_id(item_id, customer_id=None, order_id=None):
+    """Get a single order item by ID, optionally scoped to an order and a customer"""
+    try:
+        conditions = ["oi.item_id = $1"]
+        params = [int(item_id)]
+
+        if order_id is not None:
+            params.append(int(order_id))
+            conditions.append(f"oi.order_id = ${len(params)}")
+
+        if customer_id is None:
+            query = "SELECT oi.* FROM order_items oi"
+        else:
+            params.append(int(customer_id))
+            query = "SELECT oi.* FROM order_items oi JOIN orders o ON o.order_id = oi.order_id"
+            conditions.append(f"o.customer_id = ${len(params)}")
+
+        item = await _fetchrow(f"{query} WHERE {' AND '.join(conditions)}", *params)
+        return dict(item) if item else None
+    except Exception:
+        logger.exception("Error getting order item")
+        return None
+
+async def update_order(customer_id, order_id, item_id, new_product_name=None, new_quantity=None):
     """Update an item in an order"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        
-        with conn.cursor() as cursor:
-            # Verify the order belongs to the customer
-            cursor.execute(
-                "SELECT 1 FROM orders WHERE order_id = %s AND customer_id = %s",
-                (order_id, customer_id)
-            )
-            if cursor.fetchone() is None:
-                conn.close()
-                return False  # Order not found or doesn't belong to customer
-            
-            # Build the update query based on provided parameters
-            update_parts = []
-            params = []
-            
-            if new_product_name is not None:
-                update_parts.append("product_name = %s")
-                params.append(new_product_name)
-            
-            if new_quantity is not None:
-                update_parts.append("quantity = %s")
-                params.append(new_quantity)
-            
-            if not update_parts:
-                conn.close()
-                return False  # No updates to make
-            
-            # Complete the parameter list
-            params.append(order_id)
-            params.append(item_id)
-            
-            # Execute the update
-            query = f"""
-                UPDATE order_items
-                SET {', '.join(update_parts)}
-                WHERE order_id = %s AND item_id = %s
-            """
-            cursor.execute(query, params)
-            
-            success = cursor.rowcount > 0
-        conn.close()
-        return success
-    except Exception as e:
-        print(f"Error updating order: {e}")
+        # Build the update query based on provided parameters
+        update_parts = []
+        params = []
+
+        if new_product_name is not None:
+            params.append(new_product_name)
+            update_parts.append(f"product_name = ${len(params)}")
+
+        if new_quantity is not None:
+            params.append(int(new_quantity))
+            update_parts.append(f"quantity = ${len(params)}")
+
+        if not update_parts:
+            return False  # No updates to make
+
+        # Complete the parameter list
+        params.append(int(item_id))
+        params.append(int(order_id))
+        params.append(int(customer_id))
+
+        # Ownership check and update in one statement: nothing matches unless
+        # the order belongs to the customer
+        query = f"""
+            UPDATE order_items
+            SET {', '.join(update_parts)}
+            WHERE item_id = ${len(params) - 2}
+              AND order_id IN (
+                  SELECT order_id FROM orders
+                  WHERE order_id = ${len(params) - 1} AND customer_id = ${len(params)}
+              )
+        """
+
+        status = await _execute(query, *params)
+
+        return _rows_affected(status) > 0
+    except Exception:
+        logger.exception("Error updating order")
         return False
 
-def add_item_to_order(order_id, product_name, quantity, price, product_id=None):
+async def add_item_to_order(order_id, product_name, quantity, price, product_id=None):
     """Add new item to existing order"""
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """INSERT INTO order_items (order_id, product_name, quantity, price, product_id)
-                   VALUES (%s, %s, %s, %s, %s)""",
-                (order_id, product_name, quantity, price, product_id)
-            )
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"Error adding item: {e}")
+        await _execute_once(
+            """INSERT INTO order_items (order_id, product_name, quantity, price, product_id)
+               VALUES ($1, $2, $3, $4, $5)""",
+            int(order_id), product_name, int(quantity), Decimal(str(price)), product_id
+        )
+        return True
+    except Exception:
+        logger.exception("Error adding item")
         return False
-    finally:
-        conn.close()
-    
-def update_customer_info(customer_id, field, value):
+
+async def update_customer_info(customer_id, field, value):
     """Update a customer's information"""
     try:
-        conn = get_db_connection()
-        if not conn:
+        # Check if the field is valid
+        valid_fields = ["name", "email", "phone"]
+        if field.lower() not in valid_fields:
             return False
-        
-        # Convert string parameters to integers if needed
-        customer_id = int(customer_id) if isinstance(customer_id, str) else customer_id
-        
-        with conn.cursor() as cursor:
-            # Check if the field is valid
-            valid_fields = ["name", "email", "phone"]
-            if field.lower() not in valid_fields:
-                return False
-            
-            # Build and execute update query
-            query = f"UPDATE customers SET {field.lower()} = %s WHERE customer_id = %s"
-            cursor.execute(query, (value, customer_id))
-            
-            success = cursor.rowcount > 0
-        conn.close()
-        return success
-    except Exception as e:
-        print(f"Error updating customer info: {e}")
+
+        # Build and execute update query
+        query = f"UPDATE customers SET {field.lower()} = $1 WHERE customer_id = $2"
+        status = await _execute(query, value, int(customer_id))
+
+        _customer_cache.pop(int(customer_id), None)
+        return _rows_affected(status) > 0
+    except Exception:
+        logger.exception("Error updating customer info")
         return False
 
-def cancel_order(customer_id, order_id):
-    """Cancel an order"""
+async def cancel_order(customer_id, order_id):
+    """Cancel an order
+
+    Returns (success, refund_amount, cancelled_at); the refund is the order's
+    item total, computed in the same statement as the cancellation.
+    """
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
-        
-        with conn.cursor() as cursor:
-            # Verify the order belongs to the customer
-            cursor.execute(
-                "SELECT 1 FROM orders WHERE order_id = %s AND customer_id = %s",
-                (order_id, customer_id)
-            )
-            if cursor.fetchone() is None:
-                conn.close()
-                return False  # Order not found or doesn't belong to customer
-            
-            # Update the order status to 'Cancelled'
-            cursor.execute(
-                "UPDATE orders SET status = 'Cancelled' WHERE order_id = %s",
-                (order_id,)
+        # Only cancels when the order belongs to the customer
+        row = await _fetchrow(
+            """
+            WITH cancelled AS (
+                UPDATE orders SET status = 'Cancelled'
+                WHERE order_id = $1 AND customer_id = $2
+                RETURNING order_id
             )
-            
-            success = cursor.rowcount > 0
-        conn.close()
-        return success
-    except Exception as e:
-        print(f"Error cancelling order: {e}")
-        return False
\ No newline at end of file
+            SELECT
+                COALESCE(SUM(oi.price * oi.quantity), 0) AS refund_amount,
+                now() AS cancelled_at
+            FROM cancelled c
+            LEFT JOIN order_items oi ON oi.order_id = c.order_id
+            GROUP BY c.order_id
+            """,
+            int(order_id), int(customer_id)
+        )
+
+        if not row:
+            return False, None, None
+        return True, row['refund_amount'], row['cancelled_at']
+    except Exception:
+        logger.exception("Error cancelling order")
+        return False, None, None
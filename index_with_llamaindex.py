@@ -1,23 +1,90 @@
 import os
+import asyncio
+import hashlib
+import sqlite3
+import numpy as np
 import pandas as pd
+import polars as pl
 from dotenv import load_dotenv
-from llama_index.core import Document, VectorStoreIndex
-from llama_index.vector_stores.elasticsearch import ElasticsearchStore
-from llama_index.core import StorageContext
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core import Settings
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from tqdm import tqdm
-from elasticsearch import Elasticsearch
-import time
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch import ConnectionError as ESConnectionError, ConnectionTimeout
 
 # Load environment variables
 load_dotenv()
 
-# Configure LlamaIndex embeddings
-Settings.embed_model = OpenAIEmbedding(
-    model="text-embedding-3-small",
-    api_key=os.getenv("OPENAI_API_KEY")
-)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256  # Texts per embeddings request (API max is 2048)
+EMBEDDING_CONCURRENCY = 20  # Max in-flight embedding requests
+MAX_RETRIES = 5  # Attempts for embedding requests and bulk slices
+EMBEDDING_DIMS = 1536  # text-embedding-3-small dimension
+EMBEDDING_CACHE_PATH = os.path.join("cache", "emb_cache.sqlite")
+
+# Only the columns used to build documents are read from the CSV
+CSV_COLUMNS = [
+    'PRODUCT_NAME', 'BRAND', 'CATEGORY', 'DEPARTMENT', 'SUBCATEGORY',
+    'PRICE_CURRENT', 'PRODUCT_SIZE', 'SKU', 'BREADCRUMBS', 'PRODUCT_URL'
+]
+CSV_DTYPES = {
+    'BRAND': 'category',
+    'CATEGORY': 'category',
+    'DEPARTMENT': 'category',
+    'SUBCATEGORY': 'category',
+    'PRICE_CURRENT': 'float32'
+}
+
+BULK_THREAD_COUNT = 8  # Match to the number of cores on the ES nodes
+BULK_CHUNK_SIZE = 500
+INDEX_SLICE_SIZE = 2000  # Documents embedded and held in memory at once
+
+# Skip periodic refreshes and replica copies while bulk loading; restored once loaded
+INGEST_SETTINGS = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+SERVING_SETTINGS = {"index": {"refresh_interval": "1s", "number_of_replicas": 1}}
+
+# Product documents: searchable text, vector, and the metadata returned to the bot
+INDEX_MAPPINGS = {
+    "properties": {
+        "content": {"type": "text"},
+        "embedding": {
+            "type": "dense_vector",
+            "dims": EMBEDDING_DIMS,
+            "index": True,
+            # Vectors are unit length, so dot product ranks like cosine but is cheaper
+            "similarity": "dot_product",
+            # Quantize the HNSW vectors to int8 (ES 8.12+): ~4x smaller index
+            "index_options": {
+                "type": "int8_hnsw",
+                "m": 16,
+                "ef_construction": 100
+            }
+        },
+        "metadata": {
+            "properties": {
+                "sku": {"type": "keyword"}
+            }
+        }
+    }
+}
+
+def has_current_mapping(es, index_name):
+    """Check that an existing index uses this script's vector mapping.
+
+    Indexes built by the old LlamaIndex pipeline use cosine, unquantized
+    vectors and node UUIDs as document IDs, so they can't be updated in place.
+    """
+    mapping = es.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    properties = mapping.get("properties", {})
+    embedding = properties.get("embedding", {})
+    expected = INDEX_MAPPINGS["properties"]["embedding"]
+    sku = properties.get("metadata", {}).get("properties", {}).get("sku", {})
+    return (
+        embedding.get("dims") == expected["dims"]
+        and embedding.get("similarity") == expected["similarity"]
+        and embedding.get("index_options", {}).get("type") == expected["index_options"]["type"]
+        and sku.get("type") == "keyword"
+    )
 
 def test_elasticsearch_connection():
     """Test connection to Elasticsearch before indexing."""
@@ -37,12 +104,17 @@ def test_elasticsearch_connection():
         if es.indices.exists(index=index_name):
             count = es.count(index=index_name)
             print(f"✓ Index '{index_name}' already exists with {count['count']} documents")
+            current = has_current_mapping(es, index_name)
+            if not current:
+                print(f"✗ Index '{index_name}' has an outdated mapping and must be recreated")
             response = input("Do you want to delete and recreate the index? (y/n): ")
             if response.lower() == 'y':
                 es.indices.delete(index=index_name)
                 print(f"✓ Index '{index_name}' deleted")
+            elif current:
+                print("Existing documents will be updated in place")
             else:
-                print("Exiting without changes")
+                print("✗ Re-indexing into the outdated index would duplicate every product")
                 return False
         
         return True
@@ -53,175 +125,292 @@ def test_elasticsearch_connection():
 def load_and_prepare_data(file_path, limit=None):
     """Load and prepare Walmart dataset."""
     print(f"Loading data from {file_path}...")
-    df = pd.read_csv(file_path, low_memory=False)
-    
-    # Clean data
-    df = df.dropna(subset=['PRODUCT_NAME', 'PRICE_CURRENT'])
-    
-    # Convert price to float
-    df['PRICE_CURRENT'] = df['PRICE_CURRENT'].astype(float)
+    # Lazy scan: only the needed columns are parsed, and with a limit the
+    # reader stops once enough clean rows have been found
+    lazy = (
+        pl.scan_csv(
+            file_path,
+            # Read identifiers as text so SKUs keep their exact form
+            schema_overrides={col: pl.Utf8 for col in CSV_COLUMNS if col != 'PRICE_CURRENT'}
+        )
+        .select(CSV_COLUMNS)
+        .drop_nulls(['PRODUCT_NAME', 'PRICE_CURRENT'])
+    )
     
     if limit:
-        df = df.head(limit)
+        lazy = lazy.head(limit)
+    
+    df = lazy.collect().to_pandas().astype(CSV_DTYPES)
     
     print(f"✓ Loaded {len(df)} products")
     return df
 
+def text_column(df, name, default):
+    """Return a column as strings with missing values (or a missing column) set to default."""
+    if name not in df:
+        return pd.Series(default, index=df.index, dtype="string")
+    # "string" first so category columns accept a fill value outside their categories
+    return df[name].astype("string").fillna(default)
+
+def build_document_texts(df):
+    """Build the searchable text for every product with vectorized string ops."""
+    return (
+        "Product: " + df['PRODUCT_NAME'].astype(str)
+        + "\nBrand: " + text_column(df, 'BRAND', 'Unknown')
+        + "\nCategory: " + text_column(df, 'CATEGORY', 'Unknown')
+        + "\nDepartment: " + text_column(df, 'DEPARTMENT', 'Unknown')
+        + "\nSubcategory: " + text_column(df, 'SUBCATEGORY', 'Unknown')
+        + "\nPrice: " + df['PRICE_CURRENT'].map("${:.2f}".format)
+        + "\nSize: " + text_column(df, 'PRODUCT_SIZE', 'Unknown')
+        + "\nDescription: " + text_column(df, 'BREADCRUMBS', '')
+    )
+
+def build_document_metadata(df):
+    """Build the metadata dict for every product from whole columns."""
+    metadata = pd.DataFrame({
+        "name": df['PRODUCT_NAME'].astype(str),
+        "brand": text_column(df, 'BRAND', 'Unknown'),
+        "category": text_column(df, 'CATEGORY', 'Unknown'),
+        "department": text_column(df, 'DEPARTMENT', 'Unknown'),
+        "subcategory": text_column(df, 'SUBCATEGORY', 'Unknown'),
+        # float32 column; round so the stored value reads as a price
+        "price": df['PRICE_CURRENT'].astype("float64").round(2),
+        "size": text_column(df, 'PRODUCT_SIZE', 'Unknown'),
+        "sku": text_column(df, 'SKU', ''),
+        "breadcrumbs": text_column(df, 'BREADCRUMBS', ''),
+        "url": text_column(df, 'PRODUCT_URL', ''),
+    })
+    return metadata.to_dict('records')
+
 def create_documents(df):
-    """Create LlamaIndex Document objects from dataframe."""
-    documents = []
+    """Create document dicts (id, text, metadata) from dataframe."""
+    # Rich text representation for better search
+    texts = build_document_texts(df).tolist()
+    metadatas = build_document_metadata(df)
     
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Creating documents"):
-        # Create rich text representation for better search
-        doc_text = f"""
-        Product: {row['PRODUCT_NAME']}
-        Brand: {row.get('BRAND', 'Unknown')}
-        Category: {row.get('CATEGORY', 'Unknown')}
-        Department: {row.get('DEPARTMENT', 'Unknown')}
-        Subcategory: {row.get('SUBCATEGORY', 'Unknown')}
-        Price: ${row['PRICE_CURRENT']:.2f}
-        Size: {row.get('PRODUCT_SIZE', 'Unknown')}
-        Description: {row.get('BREADCRUMBS', '')}
-        """
-        
-        # Create metadata
-        metadata = {
-            "name": str(row['PRODUCT_NAME']),
-            "brand": str(row.get('BRAND', 'Unknown')),
-            "category": str(row.get('CATEGORY', 'Unknown')),
-            "department": str(row.get('DEPARTMENT', 'Unknown')),
-            "subcategory": str(row.get('SUBCATEGORY', 'Unknown')),
-            "price": float(row['PRICE_CURRENT']),
-            "size": str(row.get('PRODUCT_SIZE', 'Unknown')),
-            "sku": str(row.get('SKU', '')),
-            "breadcrumbs": str(row.get('BREADCRUMBS', '')),
-            "url": str(row.get('PRODUCT_URL', '')),
-        }
-        
-        # Create Document
-        doc = Document(
-            text=doc_text.strip(),
-            metadata=metadata,
-            doc_id=str(row.get('SKU', idx))  # Use SKU as doc_id if available
+    # Use SKU as the document id if available
+    return [
+        {"id": metadata['sku'] or str(idx), "text": text, "metadata": metadata}
+        for idx, text, metadata in zip(df.index, texts, metadatas)
+    ]
+
+def open_embedding_cache(path=EMBEDDING_CACHE_PATH):
+    """Open (creating if needed) the on-disk embedding cache."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache = sqlite3.connect(path)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+    )
+    return cache
+
+def embedding_cache_key(text):
+    """Cache key for a text: content hash, scoped to the embedding model."""
+    return hashlib.sha1(f"{EMBEDDING_MODEL}:{text}".encode("utf-8")).hexdigest()
+
+def load_cached_embeddings(cache, keys):
+    """Return {key: embedding} for the keys present in the cache."""
+    found = {}
+    # Stay under SQLite's bound-parameter limit
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        rows = cache.execute(
+            f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+            chunk
         )
-        documents.append(doc)
-    
+        for key, blob in rows:
+            found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+    return found
+
+def store_cached_embeddings(cache, entries):
+    """Persist {key: embedding} pairs as float32 blobs."""
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            [(key, np.asarray(e, dtype=np.float32).tobytes()) for key, e in entries.items()]
+        )
+
+def unit_vector(embedding):
+    """L2-normalize an embedding in float32, as dot_product similarity requires."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+async def embed_documents(documents, cache=None, concurrency=EMBEDDING_CONCURRENCY,
+                          batch_size=EMBEDDING_BATCH_SIZE):
+    """Generate embeddings for all documents in batched, concurrent requests.
+
+    Embeddings found in the cache (keyed by content hash) are reused.
+    Documents whose embedding still fails after retries keep embedding=None
+    and are skipped (and counted as failed) when indexing.
+    """
+    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    sem = asyncio.Semaphore(concurrency)
+
+    @retry(
+        retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+        wait=wait_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(MAX_RETRIES),
+        reraise=True
+    )
+    async def request_embeddings(texts):
+        response = await client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=texts
+        )
+        return [item.embedding for item in response.data]
+
+    async def embed_batch(texts, sem):
+        async with sem:
+            try:
+                return await request_embeddings(texts)
+            except Exception as e:
+                print(f"\n✗ Failed to embed batch of {len(texts)} texts: {e}")
+                return [None] * len(texts)
+
+    # Reuse embeddings from earlier runs; only texts that changed hit the API
+    keys = [embedding_cache_key(doc["text"]) for doc in documents]
+    cached = load_cached_embeddings(cache, keys) if cache else {}
+    missing = [doc for doc, key in zip(documents, keys) if key not in cached]
+
+    texts = [doc["text"] for doc in missing]
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*[embed_batch(b, sem) for b in batches])
+    embeddings = [embedding for batch in results for embedding in batch]
+
+    new_entries = {}
+    for doc, embedding in zip(missing, embeddings):
+        if embedding is not None:
+            new_entries[embedding_cache_key(doc["text"])] = embedding
+    if cache:
+        store_cached_embeddings(cache, new_entries)
+    cached.update(new_entries)
+
+    for doc, key in zip(documents, keys):
+        embedding = cached.get(key)
+        doc["embedding"] = unit_vector(embedding) if embedding is not None else None
+
+    embedded = sum(1 for doc in documents if doc["embedding"] is not None)
+    print(f"✓ {embedded}/{len(documents)} embeddings ready "
+          f"({len(documents) - len(missing)} cached, {len(batches)} API requests)")
     return documents
 
-def index_documents(documents, index_name="walmart_products", batch_size=50):
-    """Index documents using LlamaIndex and Elasticsearch."""
-    print("Setting up Elasticsearch vector store...")
+def create_index(es, index_name):
+    """Create the product index with the dense_vector mapping."""
+    if es.indices.exists(index=index_name):
+        es.indices.put_settings(index=index_name, settings=INGEST_SETTINGS)
+        return
+    es.indices.create(index=index_name, mappings=INDEX_MAPPINGS, settings=INGEST_SETTINGS)
+    print(f"✓ Created index '{index_name}'")
+
+def generate_actions(documents, index_name):
+    """Yield bulk index actions for the embedded documents."""
+    for doc in documents:
+        yield {
+            "_op_type": "index",
+            "_index": index_name,
+            "_id": doc["id"],
+            "content": doc["text"],
+            "embedding": doc["embedding"],
+            "metadata": doc["metadata"],
+        }
+
+@retry(
+    retry=retry_if_exception_type((ESConnectionError, ConnectionTimeout)),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(MAX_RETRIES),
+    reraise=True
+)
+def bulk_index(es, documents, index_name, thread_count, chunk_size):
+    """Bulk index one slice of embedded documents; returns (indexed, failed).
+
+    Actions are keyed by document id, so a retried slice overwrites rather
+    than duplicates anything already written.
+    """
+    indexed = 0
+    failed = 0
+    for ok, info in tqdm(
+        helpers.parallel_bulk(
+            es,
+            generate_actions(documents, index_name),
+            thread_count=thread_count,
+            chunk_size=chunk_size,
+            queue_size=4,
+            raise_on_error=False
+        ),
+        total=len(documents),
+        desc="Indexing"
+    ):
+        if ok:
+            indexed += 1
+        else:
+            print(f"\n✗ Failed to index document: {info}")
+            failed += 1
+    return indexed, failed
+
+def index_documents(documents, index_name="walmart_products",
+                    thread_count=BULK_THREAD_COUNT, chunk_size=BULK_CHUNK_SIZE,
+                    slice_size=INDEX_SLICE_SIZE):
+    """Embed and bulk index documents into Elasticsearch, one slice at a time."""
+    print("Setting up Elasticsearch index...")
     
-    # Create Elasticsearch vector store with extended timeout and retry settings
-    vector_store = ElasticsearchStore(
-        index_name=index_name,
-        es_cloud_id=os.getenv("ES_CLOUD_ID"),
-        es_user=os.getenv("ES_USERNAME"),
-        es_password=os.getenv("ES_PASSWORD"),
-        embedding_dimension=1536,  # text-embedding-3-small dimension
-        timeout=120,  # Increase timeout to 120 seconds
+    es = Elasticsearch(
+        cloud_id=os.getenv("ES_CLOUD_ID"),
+        basic_auth=(os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD")),
+        request_timeout=120,
         retry_on_timeout=True,
         max_retries=3
     )
+    create_index(es, index_name)
+    cache = open_embedding_cache()
     
-    # Create storage context
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-    
-    print(f"Creating index and generating embeddings in batches of {batch_size}...")
-    
-    index = None
     successful_docs = 0
     failed_docs = 0
+    total_slices = (len(documents) + slice_size - 1) // slice_size
     
-    # Process documents in smaller batches
-    for i in range(0, len(documents), batch_size):
-        batch = documents[i:i + batch_size]
-        batch_num = i // batch_size + 1
-        total_batches = (len(documents) + batch_size - 1) // batch_size
+    try:
+        for start in range(0, len(documents), slice_size):
+            doc_slice = documents[start:start + slice_size]
+            print(f"\n--- Processing slice {start // slice_size + 1}/{total_slices} ---")
         
-        print(f"\n--- Processing batch {batch_num}/{total_batches} ---")
+            # Generate embeddings concurrently before indexing
+            print("Generating embeddings...")
+            asyncio.run(embed_documents(doc_slice, cache=cache))
         
-        try:
-            if i == 0:
-                # Create initial index with first batch
-                print("Creating initial index...")
-                index = VectorStoreIndex.from_documents(
-                    batch,
-                    storage_context=storage_context,
-                    show_progress=True
-                )
-                successful_docs += len(batch)
-            else:
-                # Add subsequent batches to existing index
-                print(f"Adding documents to existing index...")
-                for doc in tqdm(batch, desc=f"Batch {batch_num}"):
-                    try:
-                        index.insert(doc)
-                        successful_docs += 1
-                    except Exception as doc_error:
-                        print(f"\n✗ Failed to insert document {doc.doc_id}: {doc_error}")
-                        failed_docs += 1
-                        continue
-                    
-            print(f"✓ Batch {batch_num} completed successfully")
-            
-            # Add a small delay between batches to avoid overwhelming the API
-            if i + batch_size < len(documents):
-                time.sleep(2)
-                
-        except Exception as e:
-            print(f"\n✗ Error processing batch {batch_num}: {e}")
-            print("Retrying with smaller mini-batches...")
-            
-            # Retry with even smaller batches
-            mini_batch_size = 10
-            for j in range(0, len(batch), mini_batch_size):
-                mini_batch = batch[j:j + mini_batch_size]
-                print(f"  Processing mini-batch {j//mini_batch_size + 1}...")
-                
-                try:
-                    if index is None:
-                        index = VectorStoreIndex.from_documents(
-                            mini_batch,
-                            storage_context=storage_context,
-                            show_progress=False
-                        )
-                        successful_docs += len(mini_batch)
-                    else:
-                        for doc in mini_batch:
-                            try:
-                                index.insert(doc)
-                                successful_docs += 1
-                            except Exception as mini_e:
-                                print(f"  ✗ Failed to insert document {doc.doc_id}: {mini_e}")
-                                failed_docs += 1
-                                continue
-                            
-                    time.sleep(1)  # Small delay between mini-batches
-                    
-                except Exception as mini_batch_error:
-                    print(f"  ✗ Failed mini-batch: {mini_batch_error}")
-                    failed_docs += len(mini_batch)
-                    continue
+            embedded = [doc for doc in doc_slice if doc["embedding"] is not None]
+            failed_docs += len(doc_slice) - len(embedded)
+        
+            print(f"Indexing {len(embedded)} documents with {thread_count} threads...")
+        
+            indexed, failed = bulk_index(es, embedded, index_name, thread_count, chunk_size)
+            successful_docs += indexed
+            failed_docs += failed
+        
+            # Vectors are in Elasticsearch now; drop them so memory stays bounded by one slice
+            for doc in embedded:
+                doc["embedding"] = None
+    finally:
+        cache.close()
+        # Back to normal search settings, then compact the freshly written segments
+        es.indices.put_settings(index=index_name, settings=SERVING_SETTINGS)
+        es.indices.refresh(index=index_name)
+        es.indices.forcemerge(index=index_name, max_num_segments=1)
     
     print(f"\n--- Indexing Summary ---")
     print(f"✓ Successfully indexed: {successful_docs} documents")
     print(f"✗ Failed to index: {failed_docs} documents")
     print(f"Total processed: {successful_docs + failed_docs} documents")
     
-    return index
+    return successful_docs
 
 def main():
     # Configuration
     csv_path = "walmart_grocery_products.csv"
     limit = 1000  # Limit to 1000 products for testing
-    batch_size = 50  # Smaller batch size to avoid timeouts
     
     # Test connection first
     print("Testing Elasticsearch connection...")
     if not test_elasticsearch_connection():
-        print("\n✗ Cannot proceed without a valid Elasticsearch connection.")
-        print("Please check your credentials and network connectivity.")
+        print("\n✗ Cannot proceed without a valid Elasticsearch connection and index.")
+        print("Please check your credentials and network connectivity, or recreate the index.")
         return
     
     try:
@@ -231,24 +420,25 @@ def main():
         # Create documents
         documents = create_documents(df)
         
-        # Index documents with batch processing
-        index = index_documents(documents, batch_size=batch_size)
+        # Embed and index documents with parallel bulk requests
+        indexed = index_documents(documents)
         
-        if index:
+        if indexed:
             print("\n✓ Indexing complete!")
             
-            # Test with a simple query
-            print("\nTesting with a sample query...")
-            query_engine = index.as_query_engine()
+            # Test with a few sample queries
+            print("\nTesting with sample queries...")
+            from product_search import search_products_batch, format_product_results
             
             test_queries = ["cheese", "organic milk", "gluten free bread"]
-            for query in test_queries:
+            for query, results in zip(test_queries, search_products_batch(test_queries, top_k=3)):
                 print(f"\nTesting query: '{query}'")
-                try:
-                    response = query_engine.query(query)
-                    print(f"✓ Response: {str(response)[:200]}...")
-                except Exception as query_error:
-                    print(f"✗ Query failed: {query_error}")
+                if results:
+                    print(format_product_results(results))
+                elif results is None:
+                    print("✗ Search failed")
+                else:
+                    print("✗ No products found")
         else:
             print("\n✗ Failed to create index")
             
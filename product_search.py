@@ -1,112 +1,510 @@
 import os
+import time
+import asyncio
+import functools
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from llama_index.vector_stores.elasticsearch import ElasticsearchStore
-from llama_index.core import VectorStoreIndex, StorageContext
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core import Settings
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+from elasticsearch.serializer import JSONSerializer
+from cachetools import LRUCache
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # Load environment variables
 load_dotenv()
 
-# Configure LlamaIndex globally
-Settings.embed_model = OpenAIEmbedding(
-    model="text-embedding-3-small",
-    api_key=os.getenv("OPENAI_API_KEY")
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "walmart_products"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+EMBEDDING_DIMS = 1536
+
+# Query results are reused for a query whose embedding is at least this
+# similar (cosine) to one searched recently
+SEMANTIC_CACHE_SIZE = 256
+SEMANTIC_CACHE_THRESHOLD = 0.86
+SEMANTIC_CACHE_TTL = 600  # seconds
+
+# Concurrent query embeddings arriving within this window share one request
+EMBEDDING_FLUSH_MS = 80
+EMBEDDING_MAX_BATCH = 32
+
+# Concurrent kNN searches arriving within this window share one msearch
+SEARCH_FLUSH_MS = 10
+SEARCH_MAX_BATCH = 32
+
+# HNSW candidates per shard default to max(MIN_NUM_CANDIDATES, 1.5 * k)
+MIN_NUM_CANDIDATES = 50
+
+# Vectors are stored int8-quantized (int8_hnsw); re-score oversample * k of
+# the approximate hits against the full-precision vectors. rescore_vector needs
+# ES 8.18+ and older clusters reject the whole query, so it is off unless
+# ES_RESCORE_OVERSAMPLE is set (e.g. 3.0)
+RESCORE_OVERSAMPLE = float(os.getenv("ES_RESCORE_OVERSAMPLE", 0)) or None
+
+# Only the product metadata is read from hits, not the stored 1536-float vector
+PRODUCT_SOURCE = ["metadata"]
+
+# Response fields the search path reads; everything else is pruned server-side
+SEARCH_FILTER_PATH = ["hits.hits._source", "hits.hits._score"]
+MSEARCH_FILTER_PATH = ["responses.hits.hits._source", "responses.hits.hits._score", "responses.error"]
+
+class OrjsonSerializer(JSONSerializer):
+    """JSON serializer backed by orjson for faster request/response encoding."""
+    def loads(self, data):
+        return orjson.loads(data)
+    
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return super().dumps(data)
+        return orjson.dumps(data, default=self.default)
+
+# Shared clients: keep-alive connections reused across handlers, gzip on the wire.
+# The async client serves the voice session; the sync one serves scripts.
+ES_CLIENT_OPTIONS = dict(
+    cloud_id=os.getenv("ES_CLOUD_ID"),
+    basic_auth=(os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD")),
+    http_compress=True,
+    connections_per_node=32,
+    request_timeout=3,
+    retry_on_timeout=True,
+    max_retries=2,
+    serializer=OrjsonSerializer()
 )
+es = Elasticsearch(**ES_CLIENT_OPTIONS)
+async_es = AsyncElasticsearch(**ES_CLIENT_OPTIONS)
+openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-class ProductRetriever:
-    def __init__(self):
-        # Connect to existing Elasticsearch index
-        self.vector_store = ElasticsearchStore(
-            index_name="walmart_products",
-            es_cloud_id=os.getenv("ES_CLOUD_ID"),
-            es_user=os.getenv("ES_USERNAME"),
-            es_password=os.getenv("ES_PASSWORD"),
-            embedding_dimension=1536
-        )
+# Searches run during a live call, so keep retries short
+_query_retry = retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    wait=wait_exponential(multiplier=0.25, max=2),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
+
+@_query_retry
+def embed_queries(queries):
+    """Embed one query string or a list of them; returns one vector per query."""
+    response = openai_client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=queries
+    )
+    return [item.embedding for item in response.data]
+
+@_query_retry
+async def aembed_queries(queries):
+    """Async embed_queries."""
+    response = await async_openai_client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=queries
+    )
+    return [item.embedding for item in response.data]
+
+@functools.lru_cache(maxsize=1024)
+def embed_query(query_text):
+    """Embed a single query as a unit-length float32 vector, cached by exact text."""
+    return _normalize(embed_queries(query_text)[0])
+
+def _normalize(embedding):
+    """Return an embedding as a read-only unit-length float32 vector."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    vector.flags.writeable = False
+    return vector
+
+class MicroBatcher:
+    """Coalesce concurrent requests into batches handled by one call.
+
+    submit() queues an item and waits; a background task collects whatever
+    arrives within flush_ms (up to max_batch items) and hands the batch to
+    process(), which returns one result per item in order. An exception in
+    place of a result fails only that item's submit().
+    """
+    def __init__(self, flush_ms, max_batch):
+        self.flush_seconds = flush_ms / 1000
+        self.max_batch = max_batch
+        self.queue = None
+        self.worker = None
+        self.flushes = set()
+    
+    async def submit(self, item):
+        """Queue item for the next batch and return its result."""
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done() or self.worker.get_loop() is not loop:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+        future = loop.create_future()
+        await self.queue.put((item, future))
+        return await future
+    
+    async def process(self, items):
+        raise NotImplementedError
+    
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.flush_seconds
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Don't hold the next window open while this batch is in flight
+            flush = asyncio.create_task(self._flush(batch))
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+    
+    async def _flush(self, batch):
+        try:
+            results = await self.process([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+class EmbeddingBatcher(MicroBatcher):
+    """Coalesce concurrent query embeddings into batched API requests.
+
+    Results are also kept in an exact-text LRU cache.
+    """
+    def __init__(self, flush_ms=EMBEDDING_FLUSH_MS, max_batch=EMBEDDING_MAX_BATCH):
+        super().__init__(flush_ms, max_batch)
+        self.cache = LRUCache(maxsize=1024)
+    
+    async def embed(self, text):
+        """Return the unit-length embedding for text."""
+        if text in self.cache:
+            return self.cache[text]
+        return await self.submit(text)
+    
+    async def process(self, texts):
+        unique = list(dict.fromkeys(texts))
+        embeddings = await aembed_queries(unique)
+        for text, embedding in zip(unique, embeddings):
+            self.cache[text] = _normalize(embedding)
+        return [self.cache[text] for text in texts]
+
+embedding_batcher = EmbeddingBatcher()
+
+class SemanticCache:
+    """Search results for recent queries, looked up by embedding similarity.
+
+    Embeddings are stored unit-length in a fixed-size matrix, so one
+    matrix-vector product gives the cosine similarity to every entry.
+    Entries expire after ttl seconds; when full, the least used entry is
+    evicted, since a few popular queries account for most lookups.
+    """
+    def __init__(self, size=SEMANTIC_CACHE_SIZE, threshold=SEMANTIC_CACHE_THRESHOLD,
+                 ttl=SEMANTIC_CACHE_TTL, dims=EMBEDDING_DIMS):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectors = np.zeros((size, dims), dtype=np.float32)
+        self.results = [None] * size
+        self.expires = np.zeros(size)
+        self.hits = np.zeros(size, dtype=np.int64)
+    
+    def get(self, vector):
+        """Return cached results for the most similar live entry, or None."""
+        live = self.expires > time.monotonic()
+        if not live.any():
+            return None
+        sims = np.where(live, self.vectors @ vector, -1.0)
+        best = int(sims.argmax())
+        if sims[best] < self.threshold:
+            return None
+        self.hits[best] += 1
+        return self.results[best]
+    
+    def put(self, vector, results):
+        """Store results, replacing an expired slot or the least used one."""
+        expired = self.expires <= time.monotonic()
+        slot = int(expired.argmax()) if expired.any() else int(self.hits.argmin())
+        self.vectors[slot] = vector
+        self.results[slot] = results
+        self.expires[slot] = time.monotonic() + self.ttl
+        self.hits[slot] = 0
+
+# A search result; use product._asdict() where a dict is needed
+Product = namedtuple(
+    "Product",
+    "product_name score category brand price size department subcategory breadcrumbs sku url"
+)
+
+def _hit_to_product(hit):
+    """Convert an Elasticsearch hit into a Product."""
+    get = hit['_source'].get('metadata', {}).get
+    return Product(
+        get('name', ''),
+        hit['_score'],
+        get('category', ''),
+        get('brand', ''),
+        get('price', 0.0),
+        get('size', ''),
+        get('department', ''),
+        get('subcategory', ''),
+        get('breadcrumbs', ''),
+        get('sku', ''),
+        get('url', '')
+    )
+
+def _hits(response):
+    """Return the hit list of a filter_path-pruned response (the key is absent when empty)."""
+    return response.get('hits', {}).get('hits', [])
+
+def default_num_candidates(top_k):
+    """Candidates explored per shard for a top_k search."""
+    return max(MIN_NUM_CANDIDATES, int(1.5 * top_k))
+
+def knn_query(query_vector, top_k, num_candidates=None, rescore_oversample=None):
+    """Build the kNN clause for a product search.
+
+    query_vector must already be a list of floats; it is used as-is.
+
+    rescore_oversample (ES 8.18+) re-scores oversample * k quantized hits
+    against the full-precision vectors, for recall-sensitive searches.
+    """
+    knn = {
+        "field": "embedding",
+        "query_vector": query_vector,
+        "k": top_k,
+        "num_candidates": num_candidates or default_num_candidates(top_k)
+    }
+    if rescore_oversample:
+        knn["rescore_vector"] = {"oversample": rescore_oversample}
+    return knn
+
+def _msearch_body(embeddings, top_k, num_candidates, rescore_oversample):
+    """Build msearch header/body pairs, one kNN search per query embedding."""
+    searches = []
+    for embedding in embeddings:
+        searches.append({"index": INDEX_NAME})
+        searches.append({
+            "knn": knn_query(
+                _normalize(embedding).tolist(), top_k, num_candidates, rescore_oversample
+            ),
+            "size": top_k,
+            "_source": PRODUCT_SOURCE
+        })
+    return searches
+
+class SearchBatcher(MicroBatcher):
+    """Coalesce concurrent kNN searches into one msearch request."""
+    def __init__(self, flush_ms=SEARCH_FLUSH_MS, max_batch=SEARCH_MAX_BATCH):
+        super().__init__(flush_ms, max_batch)
+    
+    async def search(self, body):
+        """Run one search body (knn, size, _source) and return its Products."""
+        return await self.submit(body)
+    
+    async def process(self, bodies):
+        searches = []
+        for body in bodies:
+            searches.append({"index": INDEX_NAME})
+            searches.append(body)
+        response = await async_es.msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH)
+        results = []
+        for result in response["responses"]:
+            if "error" in result:
+                # Fail just this search so its caller doesn't cache an empty result
+                results.append(RuntimeError(f"Search in batch failed: {result['error']}"))
+            else:
+                results.append([_hit_to_product(hit) for hit in _hits(result)])
+        return results
+
+search_batcher = SearchBatcher()
+
+def _msearch_products(responses):
+    """Products per msearch sub-response; None for a search that failed."""
+    results = []
+    for result in responses:
+        if "error" in result:
+            logger.error("Search in batch failed: %s", result["error"])
+            results.append(None)
+        else:
+            results.append([_hit_to_product(hit) for hit in _hits(result)])
+    return results
+
+def search_products_batch(queries, top_k=5, num_candidates=None,
+                          rescore_oversample=RESCORE_OVERSAMPLE):
+    """
+    Search for several products at once.
+    Embeds all queries in one request and runs every kNN search in a single msearch.
+    Returns one result list per query, in the same order; None for a query
+    whose search failed.
+    """
+    if not queries:
+        return []
+    
+    try:
+        searches = _msearch_body(embed_queries(list(queries)), top_k, num_candidates, rescore_oversample)
+        responses = es.msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH)["responses"]
+        return _msearch_products(responses)
         
-        # Create storage context
-        storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
+    except Exception:
+        logger.exception("Error searching products")
+        return [None for _ in queries]
+
+async def asearch_products_batch(queries, top_k=5, num_candidates=None,
+                                 rescore_oversample=RESCORE_OVERSAMPLE):
+    """Async search_products_batch, using the async OpenAI and Elasticsearch clients."""
+    if not queries:
+        return []
+    
+    try:
+        embeddings = await aembed_queries(list(queries))
+        searches = _msearch_body(embeddings, top_k, num_candidates, rescore_oversample)
+        responses = (await async_es.msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH))["responses"]
+        return _msearch_products(responses)
         
-        # Connect to existing index
-        self.index = VectorStoreIndex.from_vector_store(
-            vector_store=self.vector_store,
-            storage_context=storage_context
+    except Exception:
+        logger.exception("Error searching products")
+        return [None for _ in queries]
+
+class ProductRetriever:
+    def __init__(self, top_k=5, num_candidates=None, rescore_oversample=RESCORE_OVERSAMPLE):
+        self.top_k = top_k
+        self.num_candidates = num_candidates or default_num_candidates(top_k)
+        self.rescore_oversample = rescore_oversample
+        self.cache = SemanticCache()
+    
+    def _knn(self, query_vector):
+        """kNN clause for an embedded query."""
+        return knn_query(
+            query_vector.tolist(), self.top_k, self.num_candidates, self.rescore_oversample
         )
-        
-        # Create retriever
-        self.retriever = self.index.as_retriever(similarity_top_k=5)
+    
+    def _knn_search(self, query_vector):
+        """Run the kNN query for an embedded query and return Products."""
+        results = es.search(
+            index=INDEX_NAME,
+            knn=self._knn(query_vector),
+            size=self.top_k,
+            source_includes=PRODUCT_SOURCE,
+            filter_path=SEARCH_FILTER_PATH
+        )
+        return [_hit_to_product(hit) for hit in _hits(results)]
     
     def search_products(self, query):
-        """Search for products using LlamaIndex retriever."""
+        """Search for products with a kNN query against the product index.
+        
+        Repeated or closely paraphrased queries are answered from the cache.
+        """
         try:
-            # Retrieve relevant products
-            results = self.retriever.retrieve(query)
+            query_vector = embed_query(query)
+            cached = self.cache.get(query_vector)
+            if cached is not None:
+                return cached
             
-            products = []
-            for result in results:
-                node = result.node
-                
-                # Extract product information from metadata
-                product = {
-                    'product_name': node.metadata.get('name', ''),
-                    'score': result.score,
-                    'category': node.metadata.get('category', ''),
-                    'brand': node.metadata.get('brand', ''),
-                    'price': node.metadata.get('price', 0.0),
-                    'size': node.metadata.get('size', ''),
-                    'department': node.metadata.get('department', ''),
-                    'subcategory': node.metadata.get('subcategory', ''),
-                    'breadcrumbs': node.metadata.get('breadcrumbs', ''),
-                    'sku': node.metadata.get('sku', ''),
-                    'url': node.metadata.get('url', '')
-                }
-                products.append(product)
+            products = self._knn_search(query_vector)
+            self.cache.put(query_vector, products)
+            return products
             
+        except Exception:
+            logger.exception("Error searching products")
+            return []
+    
+    async def asearch_products(self, query):
+        """Async search_products for the voice session.
+        
+        The query is embedded and searched through the shared batchers, so
+        concurrent sessions share embedding requests and msearch calls.
+        """
+        try:
+            query_vector = await embedding_batcher.embed(query)
+            cached = self.cache.get(query_vector)
+            if cached is not None:
+                return cached
+            
+            # Shares an msearch with searches from other sessions in the same window
+            products = await search_batcher.search({
+                "knn": self._knn(query_vector),
+                "size": self.top_k,
+                "_source": PRODUCT_SOURCE
+            })
+            self.cache.put(query_vector, products)
             return products
             
-        except Exception as e:
-            print(f"Error searching products: {e}")
+        except Exception:
+            logger.exception("Error searching products")
             return []
 
 # Global retriever instance
 product_retriever = ProductRetriever()
 
-def search_products(query_text, top_k=5):
+def search_products(query_text, top_k=5, num_candidates=None):
     """
     Global function to search products.
     Maintains backward compatibility with existing code.
     """
-    return product_retriever.search_products(query_text)
+    if top_k == product_retriever.top_k and num_candidates in (None, product_retriever.num_candidates):
+        return product_retriever.search_products(query_text)
+    return ProductRetriever(top_k=top_k, num_candidates=num_candidates).search_products(query_text)
+
+async def asearch_products(query_text, top_k=5, num_candidates=None):
+    """Async search_products."""
+    if top_k == product_retriever.top_k and num_candidates in (None, product_retriever.num_candidates):
+        return await product_retriever.asearch_products(query_text)
+    return await ProductRetriever(top_k=top_k, num_candidates=num_candidates).asearch_products(query_text)
+
+def warm_up():
+    """Run a throwaway kNN query so the HNSW graph is loaded before the first user search."""
+    try:
+        probe = np.full(EMBEDDING_DIMS, 1 / np.sqrt(EMBEDDING_DIMS), dtype=np.float32)
+        es.search(index=INDEX_NAME, knn=knn_query(probe.tolist(), 1), size=1, source=False)
+        return True
+    except Exception as e:
+        logger.warning("Search warm-up failed: %s", e)
+        return False
+
+# Warm up in the background so importing this module isn't delayed
+threading.Thread(target=warm_up, daemon=True).start()
 
 def format_product_results(products):
     """Format product results for display."""
     if not products:
         return "No products found matching your search."
     
-    formatted_results = []
+    lines = []
     for i, product in enumerate(products, 1):
-        result_text = f"{i}. {product['product_name']}"
-        
-        if product['brand'] and product['brand'] != "Unknown":
-            result_text += f"\n   Brand: {product['brand']}"
+        lines.append(f"{i}. {product.product_name}")
         
-        if product['category'] and product['category'] != "Unknown":
-            result_text += f"\n   Category: {product['category']}"
+        if product.brand and product.brand != "Unknown":
+            lines.append(f"   Brand: {product.brand}")
         
-        if product['department'] and product['department'] != "Unknown":
-            result_text += f"\n   Department: {product['department']}"
+        if product.category and product.category != "Unknown":
+            lines.append(f"   Category: {product.category}")
         
-        result_text += f"\n   Price: ${product['price']:.2f}"
+        if product.department and product.department != "Unknown":
+            lines.append(f"   Department: {product.department}")
         
-        if product['size'] and product['size'] != "Unknown":
-            result_text += f"\n   Size: {product['size']}"
+        lines.append(f"   Price: ${product.price:.2f}")
         
-        result_text += f"\n   Relevance Score: {product['score']:.3f}"
+        if product.size and product.size != "Unknown":
+            lines.append(f"   Size: {product.size}")
         
-        formatted_results.append(result_text)
+        lines.append(f"   Relevance Score: {product.score:.3f}")
+        lines.append("")
     
-    return "\n\n".join(formatted_results)
+    # Drop the blank separator after the last product
+    return "\n".join(lines[:-1])
 
 # Test functionality
 if __name__ == "__main__":
@@ -119,7 +517,7 @@ if __name__ == "__main__":
         "baby formula"
     ]
     
-    print("Testing product search with proper LlamaIndex integration...\n")
+    print("Testing product search...\n")
     
     for query in test_queries:
         print(f"Searching for: '{query}'")
@@ -4,7 +4,7 @@ import os
 import asyncio
 import inspect
 import numpy as np
-import json
+import orjson
 import websockets
 from datetime import datetime
 from collections import defaultdict
@@ -113,7 +113,7 @@ class RealtimeAPI(RealtimeEventHandler):
 
     async def _receive_messages(self):
         async for message in self.ws:
-            event = json.loads(message)
+            event = orjson.loads(message)
             if event['type'] == "error":
                 logger.error("ERROR", message)
             self.log("received:", event)
@@ -134,7 +134,7 @@ class RealtimeAPI(RealtimeEventHandler):
         self.dispatch(f"client.{event_name}", event)
         self.dispatch("client.*", event)
         self.log("sent:", event)
-        await self.ws.send(json.dumps(event))
+        await self.ws.send(orjson.dumps(event).decode())
 
     def _generate_id(self, prefix):
         return f"{prefix}{int(datetime.utcnow().timestamp() * 1000)}"
@@ -399,6 +399,9 @@ class RealtimeClient(RealtimeEventHandler):
     def _reset_config(self):
         self.session_created = False
         self.tools = {}
+        self.tools_json = None
+        self.pending_tool_calls = []
+        self.tool_tasks = set()
         self.session_config = self.default_session_config.copy()
         self.input_audio_buffer = bytearray()
         return True
@@ -421,6 +424,7 @@ class RealtimeClient(RealtimeEventHandler):
         self.realtime.on("server.response.text.delta", self._process_event)
         self.realtime.on("server.response.function_call_arguments.delta", self._process_event)
         self.realtime.on("server.response.output_item.done", self._on_output_item_done)
+        self.realtime.on("server.response.done", self._on_response_done)
 
     def _log_event(self, event):
         realtime_event = {
@@ -459,21 +463,37 @@ class RealtimeClient(RealtimeEventHandler):
         if item and item["status"] == "completed":
             self.dispatch("conversation.item.completed", {"item": item})
         if item and item.get("formatted", {}).get("tool"):
-            await self._call_tool(item["formatted"]["tool"])
+            # Run once the whole response is done, together with any other calls it made
+            self.pending_tool_calls.append(item["formatted"]["tool"])
+
+    async def _on_response_done(self, event):
+        tool_calls, self.pending_tool_calls = self.pending_tool_calls, []
+        if tool_calls:
+            # Tracked so disconnect() can cancel calls still running
+            tasks = [asyncio.create_task(self._call_tool(tool)) for tool in tool_calls]
+            self.tool_tasks.update(tasks)
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                self.tool_tasks.difference_update(tasks)
+            await self.create_response()
 
     async def _call_tool(self, tool):
         try:
-            print(tool["arguments"])
-            json_arguments = json.loads(tool["arguments"])
+            json_arguments = orjson.loads(tool["arguments"])
             tool_config = self.tools.get(tool["name"])
             if not tool_config:
                 raise Exception(f'Tool "{tool["name"]}" has not been added')
-            result = await tool_config["handler"](**json_arguments)
+            call = tool_config.get("call")
+            if call:
+                result = await call(json_arguments)
+            else:
+                result = await tool_config["handler"](**json_arguments)
             await self.realtime.send("conversation.item.create", {
                 "item": {
                     "type": "function_call_output",
                     "call_id": tool["call_id"],
-                    "output": json.dumps(result),
+                    "output": orjson.dumps(result).decode(),
                 }
             })
         except Exception as e:
@@ -482,10 +502,9 @@ class RealtimeClient(RealtimeEventHandler):
                 "item": {
                     "type": "function_call_output",
                     "call_id": tool["call_id"],
-                    "output": json.dumps({"error": str(e)}),
+                    "output": orjson.dumps({"error": str(e)}).decode(),
                 }
             })
-        await self.create_response()
 
     def is_connected(self):
         return self.realtime.is_connected()
@@ -514,6 +533,9 @@ class RealtimeClient(RealtimeEventHandler):
     async def disconnect(self):
         self.session_created = False
         self.conversation.clear()
+        # The user is gone; stop in-flight tool calls (asyncpg cancels their queries)
+        for task in self.tool_tasks:
+            task.cancel()
         if self.realtime.is_connected():
             await self.realtime.disconnect()
 
@@ -529,13 +551,38 @@ class RealtimeClient(RealtimeEventHandler):
         if not callable(handler):
             raise Exception(f'Tool "{name}" handler must be a function')
         self.tools[name] = {"definition": definition, "handler": handler}
+        self.tools_json = None
         await self.update_session()
         return self.tools[name]
 
+    async def add_tools(self, tools, tools_json=None, dispatch=None):
+        """Register (definition, handler) pairs with a single session update.
+
+        tools_json, if given, is the pre-serialized JSON array of the
+        definitions (with "type": "function") and is sent as-is. dispatch, if
+        given, maps tool names to functions that take the decoded arguments
+        dict and call the handler directly.
+        """
+        for definition, handler in tools:
+            name = definition.get("name")
+            if not name:
+                raise Exception("Missing tool name in definition")
+            if name in self.tools:
+                raise Exception(f'Tool "{name}" already added. Please use .removeTool("{name}") before trying to add again.')
+            if not callable(handler):
+                raise Exception(f'Tool "{name}" handler must be a function')
+            self.tools[name] = {"definition": definition, "handler": handler}
+            if dispatch and name in dispatch:
+                self.tools[name]["call"] = dispatch[name]
+        self.tools_json = tools_json
+        await self.update_session()
+        return True
+
     def remove_tool(self, name):
         if name not in self.tools:
             raise Exception(f'Tool "{name}" does not exist, can not be removed.')
         del self.tools[name]
+        self.tools_json = None
         return True
 
     async def delete_item(self, id):
@@ -544,6 +591,12 @@ class RealtimeClient(RealtimeEventHandler):
 
     async def update_session(self, **kwargs):
         self.session_config.update(kwargs)
+        if self.tools_json is not None and not self.session_config.get("tools"):
+            # Registered tools were serialized once up front; embed the bytes as-is
+            session = {**self.session_config, "tools": orjson.Fragment(self.tools_json)}
+            if self.realtime.is_connected():
+                await self.realtime.send("session.update", {"session": session})
+            return True
         use_tools = [
             {**tool_definition, "type": "function"}
             for tool_definition in self.session_config.get("tools", [])
@@ -1,7 +1,11 @@
-import json
-import random
+import os
+import re
+import inspect
+from types import MappingProxyType
+import orjson
+import time
+import asyncio
 import chainlit as cl
-from datetime import datetime, timedelta
 from database import (
     get_customer_by_id, 
     get_customer_orders, 
@@ -9,310 +13,351 @@ from database import (
     update_order, 
     cancel_order,
     get_order_items,
+    get_item_by_id,
     add_item_to_order,
     update_customer_info
 )
 
 import logging
-from product_search import product_retriever
+from product_search import product_retriever, asearch_products_batch
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
+# Most messages the sender posts to the frontend in one go
+MESSAGE_BATCH_SIZE = 16
+
+async def send_messages(queue):
+    """Send queued chat messages, posting whatever has piled up together."""
+    while True:
+        batch = [await queue.get()]
+        while not queue.empty() and len(batch) < MESSAGE_BATCH_SIZE:
+            batch.append(queue.get_nowait())
+        # None marks the end of the session's messages
+        messages = [message for message in batch if message is not None]
+        # One failed send shouldn't stop the sender
+        for result in await asyncio.gather(*(message.send() for message in messages), return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Error sending message", exc_info=result)
+        if len(messages) < len(batch):
+            return
+
+def post_message(content):
+    """Queue a chat message for the session's sender instead of awaiting the send."""
+    message_sender = cl.user_session.get("message_sender")
+    if message_sender is None:
+        queue = asyncio.Queue()
+        message_sender = (queue, asyncio.create_task(send_messages(queue)))
+        cl.user_session.set("message_sender", message_sender)
+    message_sender[0].put_nowait(cl.Message(content=content))
+
+async def stop_message_sender():
+    """Stop the session's message sender once it has sent the messages already queued."""
+    message_sender = cl.user_session.get("message_sender")
+    if message_sender:
+        cl.user_session.set("message_sender", None)
+        message_sender[0].put_nowait(None)
+        await message_sender[1]
+
+# How long a customer's order IDs stay cached in the session, in seconds; the
+# cache is filled when the customer is identified. Item and status writes
+# don't change which orders a customer has, so they leave it alone
+ORDER_IDS_TTL = 300
+
+MONTH_NAMES = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December"
+)
+
+def format_date(value):
+    """Format a date like strftime("%B %d, %Y") without the locale lookup"""
+    return f"{MONTH_NAMES[value.month - 1]} {value.day:02d}, {value.year}"
+
+# Read-only product catalogue for get_product_info
+PRODUCTS = MappingProxyType({
+    "P001": MappingProxyType({"name": "Wireless Earbuds", "price": 79.99, "stock": 50}),
+    "P002": MappingProxyType({"name": "Smart Watch", "price": 199.99, "stock": 30}),
+    "P003": MappingProxyType({"name": "Laptop Backpack", "price": 49.99, "stock": 100})
+})
+
+def _dumps(obj):
+    """Serialize a handler result to a JSON string"""
+    return orjson.dumps(obj).decode()
+
+# Product info is fixed, so serialize it once
+PRODUCT_INFO_JSON = MappingProxyType(
+    {product_id: _dumps(dict(info)) for product_id, info in PRODUCTS.items()}
+)
+PRODUCT_NOT_FOUND_JSON = _dumps("Product not found")
+
+# HTML templates live in the project root; read and compile them once at import
+TEMPLATE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A str.format-style field such as {order_id}; {{ and }} are escaped braces
+FIELD_PATTERN = re.compile(r"(?<!\{)\{(\w+)\}(?!\})")
+
+class HtmlTemplate:
+    """A template precompiled into literal chunks and the slots its fields fill"""
+
+    def __init__(self, chunks, slots):
+        self.chunks = tuple(chunks)
+        self.slots = tuple(slots)
+
+    def substitute(self, **fields):
+        """Fill every slot and join the chunks"""
+        chunks = list(self.chunks)
+        for index, key in self.slots:
+            chunks[index] = str(fields[key])
+        return "".join(chunks)
+
+def _compile_template(text):
+    """Split template text into literal chunks, leaving a slot at every field"""
+    parts = FIELD_PATTERN.split(text)
+    chunks = [
+        part.replace("{{", "{").replace("}}", "}") if index % 2 == 0 else None
+        for index, part in enumerate(parts)
+    ]
+    slots = [(index, parts[index]) for index in range(1, len(parts), 2)]
+    return HtmlTemplate(chunks, slots)
+
+def _load_template(filename):
+    """Read and compile a str.format-style HTML file ({name}, {{ }})"""
+    with open(os.path.join(TEMPLATE_DIR, filename), 'r') as file:
+        return _compile_template(file.read())
+
+CANCELLATION_TEMPLATE = _load_template('order_cancellation_template.html')
+CALLBACK_TEMPLATE = _load_template('callback_schedule_template.html')
+ORDER_STATUS_TEMPLATE = _load_template('order_status_template.html')
+
+def _split_template(template):
+    """Split a template into its static leading text and a template for the rest"""
+    if not template.slots:
+        return template.substitute(), HtmlTemplate([], [])
+    rest = HtmlTemplate(template.chunks[1:], [(index - 1, key) for index, key in template.slots])
+    return template.chunks[0], rest
+
+# The order status page starts with static markup that can be sent before the lookup returns
+ORDER_STATUS_HEAD, ORDER_STATUS_BODY = _split_template(ORDER_STATUS_TEMPLATE)
+
 
 # Function Definitions
-identify_customer_def = {
-    "name": "identify_customer",
-    "description": "Identify which customer is speaking",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {"type": "string"}
-        },
-        "required": ["customer_id"]
-    }
-}
-
-product_search_def = {
-    "name": "product_search",
-    "description": "Search for products in the supermarket inventory",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "query": {
-                "type": "string",
-                "description": "The product query from the customer (e.g., 'Do you have cheese?', 'Show me organic milk', 'I need gluten-free bread')"
-            }
-        },
-        "required": ["query"]
-    }
-}
-
-check_order_status_def = {
-    "name": "check_order_status",
-    "description": "Check the status of a customer's order",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "order_id": {
-                "type": "string",
-                "description": "The unique identifier for the order"
-            }
-        },
-        "required": ["customer_id", "order_id"]
-    }
-}
-
-process_return_def = {
-    "name": "process_return",
-    "description": "Initiate a return process for a customer's order",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "order_id": {
-                "type": "string",
-                "description": "The unique identifier for the order to be returned"
-            },
-            "reason": {
-                "type": "string",
-                "description": "The reason for the return"
-            }
-        },
-        "required": ["customer_id", "order_id", "reason"]
-    }
-}
-
-get_product_info_def = {
-    "name": "get_product_info",
-    "description": "Retrieve information about a specific product",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "product_id": {
-                "type": "string",
-                "description": "The unique identifier for the product"
-            }
-        },
-        "required": ["customer_id", "product_id"]
-    }
-}
-
-update_account_info_def = {
-    "name": "update_account_info",
-    "description": "Update a customer's account information",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "field": {
-                "type": "string",
-                "description": "The account field to be updated (e.g., 'email', 'phone', 'address')"
-            },
-            "value": {
-                "type": "string",
-                "description": "The new value for the specified field"
-            }
-        },
-        "required": ["customer_id", "field", "value"]
-    }
-}
-
-cancel_order_def = {  
-    "name": "cancel_order",  
-    "description": "Cancel a customer's order before it is processed",  
-    "parameters": {  
-        "type": "object",  
-        "properties": {  
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "order_id": {  
-                "type": "string",  
-                "description": "The unique identifier of the order to be cancelled"  
-            },  
-            "reason": {  
-                "type": "string",  
-                "description": "The reason for cancelling the order"  
-            }  
-        },  
-        "required": ["customer_id", "order_id", "reason"]  
-    }  
-}  
-
-schedule_callback_def = {  
-    "name": "schedule_callback",  
-    "description": "Schedule a callback with a customer service representative",  
-    "parameters": {  
-        "type": "object",  
-        "properties": {  
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "callback_time": {  
-                "type": "string",  
-                "description": "Preferred time for the callback in ISO 8601 format"  
-            }  
-        },  
-        "required": ["customer_id", "callback_time"]  
-    }  
-}  
-
-get_customer_info_def = {  
-    "name": "get_customer_info",  
-    "description": "Retrieve information about a specific customer",  
-    "parameters": {  
-        "type": "object",  
-        "properties": {  
-            "customer_id": {  
-                "type": "string",  
-                "description": "The unique identifier for the customer"  
-            }  
-        },  
-        "required": ["customer_id"]  
-    }  
-}  
-
-get_order_item_def = {
-    "name": "get_order_item",
-    "description": "Get details of a specific item in an order",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "item_id": {
-                "type": "string",
-                "description": "The unique identifier for the item"
-            },
-            "order_id": {
-                "type": "string",
-                "description": "The unique identifier for the order (optional)"
-            }
-        },
-        "required": ["item_id"]
-    }
-}
-
-update_order_item_def = {
-    "name": "update_order_item",
-    "description": "Update an item in a customer's order",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {
-                "type": "string",
-                "description": "The unique identifier for the customer"
-            },
-            "order_id": {
-                "type": "string",
-                "description": "The unique identifier for the order"
-            },
-            "item_id": {
-                "type": "string",
-                "description": "The unique identifier for the item to update"
-            },
-            "new_product_name": {
-                "type": "string",
-                "description": "The new product name (optional)"
-            },
-            "new_quantity": {
-                "type": "integer",
-                "description": "The new quantity (optional)"
-            }
-        },
-        "required": ["customer_id", "order_id", "item_id"]
+def _param(spec):
+    """Expand a parameter spec: a type name, a (type, description) pair, or a full schema dict"""
+    if isinstance(spec, str):
+        return {"type": spec}
+    if isinstance(spec, tuple):
+        return {"type": spec[0], "description": spec[1]}
+    return spec
+
+def _fn(name, description, /, optional=(), **params):
+    """Build a function definition; every parameter is required unless listed in optional"""
+    return {
+        "name": name,
+        "description": description,
+        "parameters": {
+            "type": "object",
+            "properties": {key: _param(spec) for key, spec in params.items()},
+            "required": [key for key in params if key not in optional]
+        }
     }
-}
-
-add_item_to_order_def = {
-    "name": "add_item_to_order",
-    "description": "Add a new item to an existing order",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "order_id": {"type": "string"},
-            "product_name": {"type": "string"},
-            "quantity": {"type": "integer"},
-            "price": {"type": "number"}
-        },
-        "required": ["order_id", "product_name", "quantity", "price"]
+
+CUSTOMER_ID = ("string", "The unique identifier for the customer")
+ORDER_ID = ("integer", "The unique identifier for the order")
+
+identify_customer_def = _fn(
+    "identify_customer", "Identify which customer is speaking",
+    customer_id="string"
+)
+
+product_search_def = _fn(
+    "product_search", "Search for products in the supermarket inventory",
+    optional=("queries",),
+    query=("string", "The product query from the customer (e.g., 'Do you have cheese?', 'Show me organic milk', 'I need gluten-free bread')"),
+    queries={
+        "type": "array",
+        "items": {"type": "string"},
+        "description": "One query per product when the customer asks for several different products at once (e.g., ['milk', 'bread'])"
     }
-}
+)
+
+check_order_status_def = _fn(
+    "check_order_status", "Check the status of a customer's order",
+    customer_id=CUSTOMER_ID,
+    order_id=ORDER_ID
+)
+
+process_return_def = _fn(
+    "process_return", "Initiate a return process for a customer's order",
+    customer_id=CUSTOMER_ID,
+    order_id=("string", "The unique identifier for the order to be returned"),
+    reason=("string", "The reason for the return")
+)
+
+get_product_info_def = _fn(
+    "get_product_info", "Retrieve information about a specific product",
+    customer_id=CUSTOMER_ID,
+    product_id=("string", "The unique identifier for the product")
+)
+
+update_account_info_def = _fn(
+    "update_account_info", "Update a customer's account information",
+    customer_id=CUSTOMER_ID,
+    field=("string", "The account field to be updated (e.g., 'email', 'phone', 'address')"),
+    value=("string", "The new value for the specified field")
+)
+
+cancel_order_def = _fn(
+    "cancel_order", "Cancel a customer's order before it is processed",
+    customer_id=CUSTOMER_ID,
+    order_id=("integer", "The unique identifier of the order to be cancelled"),
+    reason=("string", "The reason for cancelling the order")
+)
+
+schedule_callback_def = _fn(
+    "schedule_callback", "Schedule a callback with a customer service representative",
+    customer_id=CUSTOMER_ID,
+    callback_time=("string", "Preferred time for the callback in ISO 8601 format")
+)
+
+get_customer_info_def = _fn(
+    "get_customer_info", "Retrieve information about a specific customer",
+    customer_id=CUSTOMER_ID
+)
+
+get_order_item_def = _fn(
+    "get_order_item", "Get details of a specific item in an order",
+    optional=("order_id",),
+    item_id=("integer", "The unique identifier for the item"),
+    order_id=("integer", "The unique identifier for the order (optional)")
+)
+
+update_order_item_def = _fn(
+    "update_order_item", "Update an item in a customer's order",
+    optional=("new_product_name", "new_quantity"),
+    customer_id=CUSTOMER_ID,
+    order_id=ORDER_ID,
+    item_id=("integer", "The unique identifier for the item to update"),
+    new_product_name=("string", "The new product name (optional)"),
+    new_quantity=("integer", "The new quantity (optional)")
+)
+
+add_item_to_order_def = _fn(
+    "add_item_to_order", "Add a new item to an existing order",
+    order_id="integer",
+    product_name="string",
+    quantity="integer",
+    price="number"
+)
 
 # Add this NEW function definition
-list_order_items_def = {
-    "name": "list_order_items",
-    "description": "List all items in a customer's order",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "customer_id": {"type": "string"},
-            "order_id": {"type": "string"}
-        },
-        "required": ["customer_id", "order_id"]
-    }
-}
+list_order_items_def = _fn(
+    "list_order_items", "List all items in a customer's order",
+    customer_id="string",
+    order_id="integer"
+)
 
 # Handlers
 async def identify_customer_handler(customer_id):
     """Simple customer identification for demo"""
     cl.user_session.set("customer_id", customer_id)
-    customer = get_customer_by_id(customer_id)
+    # Prefetch the orders along with the customer; most later tool calls check them
+    customer, orders = await asyncio.gather(
+        get_customer_by_id(customer_id),
+        get_customer_orders(customer_id)
+    )
     if customer:
+        if orders is not None:
+            cache_customer_orders(customer_id, orders)
         return f"Hello {customer['name']}! I can now help you with your orders."
     return "Customer not found. Please check your customer ID."
 
-async def product_search_handler(query):
-    """Handler for the product_search function using LlamaIndex"""
-    try:
-        # Use the LlamaIndex retriever
-        results = product_retriever.search_products(query)
+async def get_customer_order_ids(customer_id):
+    """Return the set of the customer's order IDs, cached in the user session"""
+    cached = cl.user_session.get("order_ids_cache")
+    now = time.monotonic()
+    if cached and cached[0] == str(customer_id) and now - cached[1] < ORDER_IDS_TTL:
+        return cached[2]
+    
+    orders = await get_customer_orders(customer_id)
+    if orders is None:
+        # Don't cache a failed lookup; the next check retries it
+        return set()
+    return cache_customer_orders(customer_id, orders)
+
+def cache_customer_orders(customer_id, orders):
+    """Store the IDs of the customer's orders in the user session"""
+    order_ids = {order['order_id'] for order in orders}
+    cl.user_session.set("order_ids_cache", (str(customer_id), time.monotonic(), order_ids))
+    return order_ids
+
+def format_search_results(results):
+    """Format product search results for the assistant"""
+    lines = []
+    
+    for i, product in enumerate(results, 1):
+        lines.append(f"{i}. {product.product_name}")
         
-        if not results:
-            return "I'm sorry, I couldn't find any matching products in our inventory."
+        if product.brand != "Unknown":
+            lines.append(f"   Brand: {product.brand}")
         
-        # Store results in session for easy addition
-        cl.user_session.set("last_search_results", results)
+        if product.department != "Unknown":
+            lines.append(f"   Department: {product.department}")
         
-        # Format the results
-        response = f"I found {len(results)} products matching '{query}':\n\n"
+        lines.append(f"   Price: ${product.price:.2f}")
         
-        for i, product in enumerate(results, 1):
-            response += f"{i}. {product['product_name']}\n"
-            
-            if product['brand'] != "Unknown":
-                response += f"   Brand: {product['brand']}\n"
+        if product.size != "Unknown":
+            lines.append(f"   Size: {product.size}")
+        
+        lines.append(f"   Match Score: {product.score:.2f}")
+        lines.append("")
+    
+    return "\n".join(lines) + "\n" if lines else ""
+
+async def product_search_handler(query, queries=None):
+    """Handler for the product_search function"""
+    try:
+        if queries and len(queries) > 1:
+            # Several products requested at once: search them all in one round trip
+            results_per_query = await asearch_products_batch(queries)
+            results = [product for products in results_per_query if products for product in products]
             
-            if product['department'] != "Unknown":
-                response += f"   Department: {product['department']}\n"
+            if not results and None in results_per_query:
+                return "I encountered an error while searching for products."
+            if not results:
+                return "I'm sorry, I couldn't find any matching products in our inventory."
             
-            response += f"   Price: ${product['price']:.2f}\n"
+            cl.user_session.set("last_search_results", results)
             
-            if product['size'] != "Unknown":
-                response += f"   Size: {product['size']}\n"
+            parts = []
+            for sub_query, products in zip(queries, results_per_query):
+                if products:
+                    parts.append(f"I found {len(products)} products matching '{sub_query}':\n\n")
+                    parts.append(format_search_results(products))
+                elif products is None:
+                    parts.append(f"I encountered an error while searching for '{sub_query}'.\n\n")
+                else:
+                    parts.append(f"I couldn't find any products matching '{sub_query}'.\n\n")
             
-            response += f"   Match Score: {product['score']:.2f}\n\n"
+            parts.append("Would you like to add any of these to your order?")
+            return "".join(parts)
         
-        response += "Would you like to add any of these to your order?"
-        return response
+        results = await product_retriever.asearch_products(query)
         
-    except Exception as e:
-        print(f"Error in product search handler: {e}")
+        if not results:
+            return "I'm sorry, I couldn't find any matching products in our inventory."
+        
+        # Store results in session for easy addition
+        cl.user_session.set("last_search_results", results)
+        
+        # Format the results
+        return "".join((
+            f"I found {len(results)} products matching '{query}':\n\n",
+            format_search_results(results),
+            "Would you like to add any of these to your order?"
+        ))
+        
+    except Exception:
+        logger.exception("Error in product search handler")
         return "I encountered an error while searching for products."
 
 async def add_item_to_order_handler(order_id, product_name, quantity, price):
@@ -323,79 +368,70 @@ async def add_item_to_order_handler(order_id, product_name, quantity, price):
         return "Please identify yourself first. What's your customer ID?"
     
     # Verify order belongs to customer
-    orders = get_customer_orders(customer_id)
-    if not any(order['order_id'] == int(order_id) for order in orders):
+    if order_id not in await get_customer_order_ids(customer_id):
         return "This order doesn't belong to you."
     
-    success = add_item_to_order(order_id, product_name, quantity, price)
+    success = await add_item_to_order(order_id, product_name, quantity, price)
     if success:
         return f"Added {quantity} {product_name} to order {order_id} at ${price} each."
     return "Failed to add item to order"
     
 async def cancel_order_handler(customer_id, order_id, reason):
     """Handler for the cancel_order function"""
-    success = cancel_order(customer_id, order_id)
+    success, refund_amount, cancellation_date = await cancel_order(customer_id, order_id)
     
     if not success:
         return f"Failed to cancel order {order_id}. Please check if the order exists and belongs to customer {customer_id}."
     
-    # Get the current date for cancellation date
-    cancellation_date = datetime.now()
-    # Mock refund amount (in a real app, you would calculate this)
-    refund_amount = round(random.uniform(10, 500), 2)
-    
-    # Read the HTML template
-    with open('order_cancellation_template.html', 'r') as file:
-        html_content = file.read()
-    
-    # Replace placeholders with actual data
-    html_content = html_content.format(
+    # Fill the HTML template with actual data
+    html_content = CANCELLATION_TEMPLATE.substitute(
         order_id=order_id,
         customer_id=customer_id,
-        cancellation_date=cancellation_date.strftime("%B %d, %Y"),
-        refund_amount=refund_amount,
+        cancellation_date=format_date(cancellation_date),
+        refund_amount=f"{refund_amount:.2f}",
         status="Cancelled"
     )
     
-    # Return the Chainlit message with HTML content
-    await cl.Message(content=f"Your order has been cancelled. Here are the details:\n{html_content}").send()
+    # Queue the Chainlit message with HTML content; the tool result doesn't wait on it
+    post_message(f"Your order has been cancelled. Here are the details:\n{html_content}")
     
     return f"Order {order_id} for customer {customer_id} has been cancelled. Reason: {reason}. A confirmation email has been sent."
   
 async def schedule_callback_handler(customer_id, callback_time):  
-    # Read the HTML template
-    with open('callback_schedule_template.html', 'r') as file:
-        html_content = file.read()
-
-    # Replace placeholders with actual data
-    html_content = html_content.format(
+    # Fill the HTML template with actual data
+    html_content = CALLBACK_TEMPLATE.substitute(
         customer_id=customer_id,
         callback_time=callback_time
     )
 
-    # Return the Chainlit message with HTML content
-    await cl.Message(content=f"Your callback has been scheduled. Here are the details:\n{html_content}").send()
+    # Queue the Chainlit message with HTML content; the tool result doesn't wait on it
+    post_message(f"Your callback has been scheduled. Here are the details:\n{html_content}")
     return f"Callback scheduled for customer {customer_id} at {callback_time}. A representative will contact you then."
   
 async def check_order_status_handler(customer_id, order_id):
     """Handler for the check_order_status function"""
-    estimated_delivery, status, order_date = get_order_details(order_id, customer_id)
+    # Start the lookup, then stream the static part of the page while it runs
+    details = asyncio.create_task(get_order_details(order_id, customer_id))
     
-    # Read the HTML template
-    with open('order_status_template.html', 'r') as file:
-        html_content = file.read()
+    try:
+        msg = cl.Message(content="Here is the detail of your order \n ")
+        await msg.send()
+        await msg.stream_token(ORDER_STATUS_HEAD)
+        
+        estimated_delivery, status, order_date = await details
+    except asyncio.CancelledError:
+        details.cancel()
+        raise
     
-    # Replace placeholders with actual data
-    html_content = html_content.format(
+    # Fill the rest of the HTML template with actual data
+    await msg.stream_token(ORDER_STATUS_BODY.substitute(
         order_id=order_id,
         customer_id=customer_id,
-        order_date=order_date.strftime("%B %d, %Y"),
-        estimated_delivery=estimated_delivery.strftime("%B %d, %Y"),
+        order_date=format_date(order_date),
+        estimated_delivery=format_date(estimated_delivery),
         status=status
-    )
-    
-    # Return the Chainlit message with HTML content
-    await cl.Message(content=f"Here is the detail of your order \n {html_content}").send()
+    ))
+    await msg.update()
     
     return f"Order {order_id} status for customer {customer_id}: {status}"
     
@@ -404,17 +440,12 @@ async def process_return_handler(customer_id, order_id, reason):
     return f"Return for order {order_id} initiated by customer {customer_id}. Reason: {reason}. Please expect a refund within 5-7 business days."
 
 async def get_product_info_handler(customer_id, product_id):
-    products = {
-        "P001": {"name": "Wireless Earbuds", "price": 79.99, "stock": 50},
-        "P002": {"name": "Smart Watch", "price": 199.99, "stock": 30},
-        "P003": {"name": "Laptop Backpack", "price": 49.99, "stock": 100}
-    }
-    product_info = products.get(product_id, "Product not found")
-    return f"Product information for customer {customer_id}: {json.dumps(product_info)}"
+    product_info = PRODUCT_INFO_JSON.get(product_id, PRODUCT_NOT_FOUND_JSON)
+    return f"Product information for customer {customer_id}: {product_info}"
 
 async def update_account_info_handler(customer_id, field, value):
     """Handler for the update_account_info function"""
-    success = update_customer_info(customer_id, field, value)
+    success = await update_customer_info(customer_id, field, value)
     
     if success:
         return f"Account information updated for customer {customer_id}. {field.capitalize()} changed to: {value}"
@@ -423,10 +454,10 @@ async def update_account_info_handler(customer_id, field, value):
 
 async def get_customer_info_handler(customer_id):
     """Handler for the get_customer_info function"""
-    customer = get_customer_by_id(customer_id)
+    customer = await get_customer_by_id(customer_id)
     
     if customer:
-        return json.dumps({
+        return _dumps({
             "customer_id": customer_id,
             "name": customer["name"],
             "email": customer["email"],
@@ -437,7 +468,7 @@ async def get_customer_info_handler(customer_id):
 
 async def update_order_item_handler(customer_id, order_id, item_id, new_product_name=None, new_quantity=None):
     """Handler for updating an order item"""
-    success = update_order(customer_id, order_id, item_id, new_product_name, new_quantity)
+    success = await update_order(customer_id, order_id, item_id, new_product_name, new_quantity)
     
     if success:
         return f"Order {order_id}, item {item_id} has been updated successfully."
@@ -446,26 +477,11 @@ async def update_order_item_handler(customer_id, order_id, item_id, new_product_
 
 async def get_order_item_handler(item_id, order_id=None):
     """Handler for getting order item details"""
-    # Convert string parameters to integers
-    item_id_int = int(item_id) if isinstance(item_id, str) else item_id
-    
-    # Use existing get_order_items function
-    if order_id:
-        order_id_int = int(order_id) if isinstance(order_id, str) else order_id
-        items = get_order_items(order_id_int)
-        # Filter for the specific item
-        item = next((i for i in items if i["item_id"] == item_id_int), None)
-    else:
-        # Search through all items (this is less efficient)
-        all_orders = get_customer_orders("1")  # Using customer_id 1 for simplicity
-        for order in all_orders:
-            items = get_order_items(order["order_id"])
-            item = next((i for i in items if i["item_id"] == item_id_int), None)
-            if item:
-                break
+    # Single lookup by primary key, scoped to the order and identified customer if known
+    item = await get_item_by_id(item_id, cl.user_session.get("customer_id"), order_id or None)
     
     if item:
-        return json.dumps({
+        return _dumps({
             "item_id": item["item_id"],
             "order_id": item["order_id"],
             "product_name": item["product_name"],
@@ -479,29 +495,30 @@ async def get_order_item_handler(item_id, order_id=None):
 async def list_order_items_handler(customer_id, order_id):
     """Handler for listing all items in an order"""
     # Verify order belongs to customer
-    orders = get_customer_orders(customer_id)
-    if not any(order['order_id'] == int(order_id) for order in orders):
+    if order_id not in await get_customer_order_ids(customer_id):
         return "This order doesn't belong to you."
     
     # Get all items in the order
-    items = get_order_items(order_id)
+    items = await get_order_items(order_id)
     
     if not items:
         return f"Order {order_id} is empty."
     
-    response = f"Order {order_id} contains the following items:\n\n"
+    parts = [f"Order {order_id} contains the following items:\n\n"]
     total = 0
     
     for item in items:
         subtotal = float(item['price']) * item['quantity']
-        response += f"• {item['product_name']}\n"
-        response += f"  Quantity: {item['quantity']}\n"
-        response += f"  Price per item: ${item['price']}\n"
-        response += f"  Subtotal: ${subtotal:.2f}\n\n"
+        parts.append(
+            f"• {item['product_name']}\n"
+            f"  Quantity: {item['quantity']}\n"
+            f"  Price per item: ${item['price']}\n"
+            f"  Subtotal: ${subtotal:.2f}\n\n"
+        )
         total += subtotal
     
-    response += f"Order Total: ${total:.2f}"
-    return response
+    parts.append(f"Order Total: ${total:.2f}")
+    return "".join(parts)
 
 
 # Tools list with all handlers
@@ -518,4 +535,38 @@ tools = [
     (get_order_item_def, get_order_item_handler), 
     (product_search_def, product_search_handler),
     (add_item_to_order_def, add_item_to_order_handler)
-]
\ No newline at end of file
+]
+
+# Registry keyed by tool name: (definition, handler)
+TOOLS_BY_NAME = {tool_def["name"]: (tool_def, handler) for tool_def, handler in tools}
+
+def _compile_call(tool_def, handler):
+    """Generate a function that calls handler with the arguments its schema declares"""
+    # Required arguments are read straight from the decoded dict and optional
+    # ones fall back to the handler's defaults; no **kwargs unpacking per call
+    parameters = tool_def["parameters"]
+    defaults = {
+        name: param.default
+        for name, param in inspect.signature(handler).parameters.items()
+        if param.default is not param.empty
+    }
+    arguments = [
+        f"{key}=args.get({key!r}, _defaults[{key!r}])"
+        if key not in parameters["required"] and key in defaults
+        else f"{key}=args[{key!r}]"
+        for key in parameters["properties"]
+    ]
+    namespace = {"_handler": handler, "_defaults": defaults}
+    exec(f"async def call(args):\n    return await _handler({', '.join(arguments)})\n", namespace)
+    return namespace["call"]
+
+# Direct call table keyed by tool name, generated once at import
+DISPATCH = {name: _compile_call(tool_def, handler) for name, (tool_def, handler) in TOOLS_BY_NAME.items()}
+
+# Tool definitions in the wire format, serialized once at import and
+# shared by every session
+TOOLS_JSON = orjson.dumps([{**tool_def, "type": "function"} for tool_def, _ in TOOLS_BY_NAME.values()])
+
+def get_tools_json():
+    """Return the pre-serialized JSON array of tool definitions."""
+    return TOOLS_JSON
@@ -0,0 +1,30 @@
+"""Compact the product index before serving traffic.
+
+Run from the project root at startup:
+    python -m scripts.optimize_index
+"""
+from product_search import es, INDEX_NAME
+
+def optimize_index(index_name=INDEX_NAME):
+    """Start a force-merge of the index to one segment without waiting for it."""
+    try:
+        if not es.indices.exists(index=index_name):
+            print(f"✗ Index '{index_name}' does not exist, skipping optimization")
+            return False
+
+        # Runs as a background task so startup isn't held up past the port-binding
+        # deadline; never re-sent, since a retry would queue a second merge.
+        # A no-op when the index is already a single segment
+        response = es.options(max_retries=0, retry_on_timeout=False).indices.forcemerge(
+            index=index_name, max_num_segments=1, wait_for_completion=False
+        )
+        print(f"✓ Started force-merge of '{index_name}' (task {response['task']})")
+
+        # The app warms up the search path itself when product_search is imported
+        return True
+    except Exception as e:
+        print(f"✗ Failed to optimize index: {e}")
+        return False
+
+if __name__ == "__main__":
+    optimize_index()
@@ -1,31 +1,28 @@
-import os
+import asyncio
 from dotenv import load_dotenv
-from product_search import search_products, format_product_results
-from elasticsearch import Elasticsearch
+from elasticsearch import NotFoundError
+from product_search import es, async_es, INDEX_NAME, asearch_products, format_product_results
 
 # Load environment variables
 load_dotenv()
 
 def check_index_status():
     """Check if the index exists and has documents."""
-    es = Elasticsearch(
-        cloud_id=os.getenv("ES_CLOUD_ID"),
-        basic_auth=(os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD"))
-    )
+    # Reuse the search module's pooled client instead of opening a new connection
+    index_name = INDEX_NAME
     
-    index_name = "walmart_products"
-    
-    if es.indices.exists(index=index_name):
+    # A single count request; a missing index comes back as a 404
+    try:
         count = es.count(index=index_name)
-        print(f"Index '{index_name}' exists with {count['count']} documents\n")
-    else:
+    except NotFoundError:
         print(f"Index '{index_name}' does not exist!\n")
         return False
     
+    print(f"Index '{index_name}' exists with {count['count']} documents\n")
     return True
 
-def test_searches():
-    """Test various product searches."""
+async def test_searches():
+    """Test various product searches, issued concurrently."""
     test_cases = [
         ("cheese", "Testing cheese products"),
         ("organic", "Testing organic products"),
@@ -37,12 +34,13 @@ def test_searches():
         ("frozen", "Testing frozen products")
     ]
     
-    for query, description in test_cases:
+    # Concurrent searches share embedding requests and msearch calls
+    all_results = await asyncio.gather(*(asearch_products(query) for query, _ in test_cases))
+    
+    for (query, description), results in zip(test_cases, all_results):
         print(f"\n{description}")
         print("=" * len(description))
         
-        results = search_products(query)
-        
         if results:
             print(f"Found {len(results)} products for '{query}':")
             print(format_product_results(results[:2]))  # Show only top 2
@@ -51,18 +49,21 @@ def test_searches():
         
         print("\n" + "-" * 50)
 
-def main():
+async def main():
     print("Product Search Testing\n")
     
-    # Check index status
-    if not check_index_status():
-        print("Please run index_with_llamaindex.py first!")
-        return
-    
-    # Run search tests
-    test_searches()
-    
-    print("\nTesting complete!")
+    try:
+        # Check index status
+        if not check_index_status():
+            print("Please run index_with_llamaindex.py first!")
+            return
+        
+        # Run search tests
+        await test_searches()
+        
+        print("\nTesting complete!")
+    finally:
+        await async_es.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file